@@ -1,5 +1,5 @@
 from flask import current_app, session, redirect, url_for
-from datetime import timedelta
+from datetime import datetime, timedelta
 from requests_oauthlib import OAuth2Session
 from oauthlib.oauth2 import TokenExpiredError
 from oauthlib.oauth2.rfc6749.errors import MissingTokenError
@@ -25,6 +25,11 @@ def get_fitbit_session():
         token_updater=lambda t: session.update({"oauth_token": t}),
     )
 
+def get_fitbit_user_id():
+    """Returns the Fitbit user id of the logged in user, used to scope per-user cache entries."""
+    token = session.get("oauth_token") or {}
+    return token.get("user_id", "-")
+
 # The data fetching functions have been moved to the FitbitService class
 # in fitbit_app/service.py. This file now only contains the session setup.
 def fetch_daily_heart_rate(fitbit, start_date, end_date):
@@ -57,6 +62,105 @@ def fetch_intraday_heart_rate(fitbit, start_datetime, end_datetime):
     hr_response = fitbit.get(hr_api_url)
     return hr_response.json() if hr_response.status_code == 200 else None
 
+# Per-day intraday heart rate entries only back the rolling "last 23 hours" views,
+# so there is no point keeping them around much longer than that.
+INTRADAY_HR_CACHE_TIMEOUT = 2 * 24 * 60 * 60
+# Samples only reach Fitbit when the device syncs, so a day's tail keeps being
+# refetched until this long after the day has ended.
+SYNC_GRACE_PERIOD = timedelta(hours=3)
+
+def fetch_intraday_heart_rate_incremental(fitbit, cache, user_id, start_datetime, end_datetime):
+    """
+    Fetches intraday heart rate data for a datetime range, reusing samples cached by earlier calls.
+
+    Samples are cached per user and day together with the time the cached series starts at.
+    Each cached day is refreshed from its newest sample, using the same time-range URL as
+    fetch_intraday_heart_rate with at most one call per calendar day, so every sample is filed
+    under the day it was requested for. The last cached minute is fetched again since Fitbit
+    may still revise it. A day is marked complete, and no longer refetched, once it has been
+    fetched more than SYNC_GRACE_PERIOD after it ended, so samples synced late still arrive.
+
+    :return: Data in the same shape as fetch_intraday_heart_rate, or None if nothing is available.
+    """
+    days = []
+    current_date = start_datetime.date()
+    while current_date <= end_datetime.date():
+        days.append(current_date)
+        current_date += timedelta(days=1)
+
+    cache_keys = {day: f"hr_intraday_{user_id}_{day.strftime('%Y-%m-%d')}" for day in days}
+    entries = dict(zip(days, cache.get_many(*cache_keys.values())))
+
+    def needed_from(day):
+        return start_datetime.strftime('%H:%M:00') if day == days[0] else '00:00:00'
+
+    def is_usable(entry, day):
+        return entry and entry['from'] <= needed_from(day)
+
+    # Complete days are skipped, other cached days are refreshed from their newest sample,
+    # and days whose entries are missing or start too late are fetched whole.
+    fetches = []
+    for day in days:
+        entry = entries.get(day)
+        if not is_usable(entry, day):
+            fetches.append((day, needed_from(day)))
+        elif not entry.get('complete'):
+            fetches.append((day, entry['dataset'][-1]['time'] if entry['dataset'] else entry['from']))
+
+    to_cache = {}
+    for day, fetch_from_time in fetches:
+        fetch_from = datetime.combine(day, datetime.strptime(fetch_from_time, '%H:%M:%S').time())
+        fetch_to = min(end_datetime, datetime.combine(day, datetime.strptime('23:59', '%H:%M').time()))
+        if fetch_from > fetch_to:
+            continue
+        fetched_data = fetch_intraday_heart_rate(fitbit, fetch_from, fetch_to)
+        if fetched_data is None:
+            current_app.logger.error(f"Incremental heart rate fetch from {fetch_from} failed, serving cached samples only.")
+            continue
+
+        samples = fetched_data.get('activities-heart-intraday', {}).get('dataset', [])
+        summaries = {item.get('dateTime'): item for item in fetched_data.get('activities-heart', [])}
+        entry = entries.get(day)
+        if is_usable(entry, day):
+            kept = [sample for sample in entry['dataset'] if sample['time'] < fetch_from_time]
+            entry = {'from': entry['from'], 'summary': entry.get('summary'), 'dataset': kept + samples}
+        else:
+            entry = {'from': fetch_from_time, 'summary': None, 'dataset': samples}
+        entry['summary'] = summaries.get(day.strftime('%Y-%m-%d'), entry['summary'])
+        entry['complete'] = end_datetime >= datetime.combine(day + timedelta(days=1), datetime.min.time()) + SYNC_GRACE_PERIOD
+        entries[day] = entry
+        to_cache[cache_keys[day]] = entry
+
+    if to_cache:
+        cache.set_many(to_cache, timeout=INTRADAY_HR_CACHE_TIMEOUT)
+
+    start_time_str = start_datetime.strftime('%H:%M:00')
+    end_time_str = end_datetime.strftime('%H:%M:59')
+    activities_heart = []
+    dataset = []
+    for day in days:
+        entry = entries.get(day)
+        if not entry:
+            continue
+        day_samples = [
+            sample for sample in entry['dataset']
+            if (day != days[0] or sample['time'] >= start_time_str) and (day != days[-1] or sample['time'] <= end_time_str)
+        ]
+        # Consumers date samples from the first activities-heart entry, so days
+        # without samples must not be listed ahead of the ones that have them.
+        if day_samples:
+            activities_heart.append(entry.get('summary') or {'dateTime': day.strftime('%Y-%m-%d'), 'value': {}})
+        dataset.extend(day_samples)
+
+    if not any(entries.values()):
+        return None
+    if not activities_heart:
+        activities_heart = [{'dateTime': days[0].strftime('%Y-%m-%d'), 'value': {}}]
+    return {
+        'activities-heart': activities_heart,
+        'activities-heart-intraday': {'dataset': dataset, 'datasetInterval': 1, 'datasetType': 'minute'},
+    }
+
 def fetch_sleep_logs(fitbit, start_datetime, end_datetime):
     """Fetches all sleep logs for a given datetime range."""
     all_sleep_logs = []
@@ -0,0 +1,500 @@
+import logging
+import pickle
+import struct
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+from cachelib import FileSystemCache, RedisCache
+from cachelib.base import BaseCache
+from cachelib.serializers import BaseSerializer, RedisSerializer
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+# Every payload written by CodecSerializer starts with this byte, followed by a
+# flags byte: low nibble is the encoding, high nibble is the compression.
+MAGIC = b"~"
+ENCODINGS = {"pickle": 0, "msgpack": 1}
+COMPRESSIONS = {"none": 0, "zlib": 1, "zstd": 2}
+
+COLUMNAR_MARKER = "__columnar__"
+# Only every Nth write also pickles the value to measure what the stock serializer
+# would have stored; the bytes-saved figure is extrapolated from those samples.
+BASELINE_SAMPLE_EVERY = 16
+EPOCH = datetime(1970, 1, 1)
+
+
+class CodecStats:
+    """Thread-safe counters describing what the cache codec is doing."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.encoded = 0
+            self.decoded = 0
+            self.compressed = 0
+            self.sampled_pickle_bytes = 0
+            self.sampled_stored_bytes = 0
+            self.encoded_bytes = 0
+            self.stored_bytes = 0
+            self.encode_seconds = 0.0
+            self.decode_seconds = 0.0
+
+    def should_sample_baseline(self):
+        with self._lock:
+            return self.encoded % BASELINE_SAMPLE_EVERY == 0
+
+    def record_encode(self, pickle_bytes, encoded_bytes, stored_bytes, seconds, compressed):
+        with self._lock:
+            self.encoded += 1
+            self.compressed += int(compressed)
+            if pickle_bytes is not None:
+                self.sampled_pickle_bytes += pickle_bytes
+                self.sampled_stored_bytes += stored_bytes
+            self.encoded_bytes += encoded_bytes
+            self.stored_bytes += stored_bytes
+            self.encode_seconds += seconds
+
+    def record_decode(self, seconds):
+        with self._lock:
+            self.decoded += 1
+            self.decode_seconds += seconds
+
+    def snapshot(self):
+        with self._lock:
+            pickle_bytes = self.stored_bytes
+            if self.sampled_stored_bytes:
+                pickle_bytes = round(self.stored_bytes * self.sampled_pickle_bytes / self.sampled_stored_bytes)
+            return {
+                "encoded": self.encoded,
+                "decoded": self.decoded,
+                "compressed": self.compressed,
+                "estimatedPickleBytes": pickle_bytes,
+                "encodedBytes": self.encoded_bytes,
+                "storedBytes": self.stored_bytes,
+                "bytesSaved": pickle_bytes - self.stored_bytes,
+                "encodeMillis": round(self.encode_seconds * 1000, 3),
+                "decodeMillis": round(self.decode_seconds * 1000, 3),
+            }
+
+
+def _encode_timestamps(values):
+    """Returns (epochs, utc_offset_seconds) if every value is an ISO timestamp that round-trips exactly, else None."""
+    epochs = []
+    offset = None
+    for i, value in enumerate(values):
+        if not isinstance(value, str) or len(value) < 19 or value[10:11] != "T":
+            return None
+        try:
+            parsed = datetime.fromisoformat(value)
+        except ValueError:
+            return None
+        if parsed.microsecond or parsed.isoformat() != value:
+            return None
+        utc_offset = parsed.utcoffset()
+        value_offset = None if utc_offset is None else int(utc_offset.total_seconds())
+        if i == 0:
+            offset = value_offset
+        elif value_offset != offset:
+            return None
+        if offset is None:
+            epochs.append(int((parsed - EPOCH).total_seconds()))
+        else:
+            epochs.append(int(parsed.timestamp()))
+    return epochs, offset
+
+
+def _decode_timestamps(epochs, offset):
+    if offset is None:
+        return [(EPOCH + timedelta(seconds=epoch)).isoformat() for epoch in epochs]
+    tz = timezone(timedelta(seconds=offset))
+    return [datetime.fromtimestamp(epoch, tz).isoformat() for epoch in epochs]
+
+
+def to_columnar(value):
+    """
+    Rewrites lists of same-shaped dicts (heart rate samples, sleep stages, ...) as columns.
+
+    Key names are stored once per list instead of once per row, and columns made up
+    entirely of ISO timestamps are stored as epoch seconds plus a single UTC offset.
+    """
+    if isinstance(value, dict):
+        return {key: to_columnar(item) for key, item in value.items()}
+    if isinstance(value, list):
+        if len(value) > 1 and all(isinstance(row, dict) for row in value):
+            keys = list(value[0].keys())
+            if all(list(row.keys()) == keys for row in value):
+                columns = []
+                timestamp_offsets = {}
+                for key in keys:
+                    column = [row[key] for row in value]
+                    timestamps = _encode_timestamps(column)
+                    if timestamps is not None:
+                        column, timestamp_offsets[key] = timestamps
+                    else:
+                        column = [to_columnar(item) for item in column]
+                    columns.append(column)
+                return {COLUMNAR_MARKER: keys, "columns": columns, "timestamps": timestamp_offsets}
+        return [to_columnar(item) for item in value]
+    return value
+
+
+def from_columnar(value):
+    """The reversal of :func:`to_columnar`."""
+    if isinstance(value, dict):
+        if COLUMNAR_MARKER in value:
+            keys = value[COLUMNAR_MARKER]
+            timestamp_offsets = value["timestamps"]
+            columns = []
+            for key, column in zip(keys, value["columns"]):
+                if key in timestamp_offsets:
+                    columns.append(_decode_timestamps(column, timestamp_offsets[key]))
+                else:
+                    columns.append([from_columnar(item) for item in column])
+            return [dict(zip(keys, row)) for row in zip(*columns)]
+        return {key: from_columnar(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [from_columnar(item) for item in value]
+    return value
+
+
+def _msgpack_default(value):
+    # Values pulled out of pandas rows are numpy scalars; msgpack only knows builtins.
+    if hasattr(value, "item"):
+        return value.item()
+    raise TypeError(f"Cannot encode object of type {type(value).__name__}")
+
+
+class CodecSerializer(RedisSerializer):
+    """
+    Cache serializer with a compact columnar encoding and optional compression.
+
+    Works as the serializer of both RedisCache and FileSystemCache. Only dicts and
+    lists go through the codec; other values (e.g. the integer counters cachelib
+    keeps) and entries written before the codec was enabled are handled exactly
+    as cachelib would.
+
+    :param encoding: "msgpack" or "pickle". Falls back to pickle if msgpack is not installed.
+    :param compression: "zstd", "zlib" or "none". zstd falls back to zlib if zstandard is not installed.
+    :param compression_threshold: Payloads smaller than this many bytes are stored uncompressed.
+    """
+
+    def __init__(self, encoding="msgpack", compression="zlib", compression_threshold=1024):
+        if encoding not in ENCODINGS:
+            raise ValueError(f"Unknown cache encoding: {encoding}")
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown cache compression: {compression}")
+        if encoding == "msgpack" and msgpack is None:
+            logger.warning("msgpack is not installed, falling back to pickle for the cache codec.")
+            encoding = "pickle"
+        if compression == "zstd" and zstandard is None:
+            logger.warning("zstandard is not installed, falling back to zlib for cache compression.")
+            compression = "zlib"
+        self.encoding = encoding
+        self.compression = compression
+        self.compression_threshold = compression_threshold
+        self.stats = CodecStats()
+
+    def _encode(self, value):
+        """Returns (encoding, payload); the encoding is recorded in the flags byte so loads can undo it."""
+        columnar = to_columnar(value)
+        if self.encoding == "msgpack":
+            try:
+                return "msgpack", msgpack.packb(columnar, default=_msgpack_default, use_bin_type=True)
+            except (TypeError, ValueError, OverflowError) as e:
+                # Values msgpack cannot represent (datetime, set, Decimal, ...) are pickled like before the codec.
+                logger.debug(f"msgpack cannot encode cache value, using pickle: {e}")
+        return "pickle", pickle.dumps(columnar, pickle.HIGHEST_PROTOCOL)
+
+    def _decode(self, encoding, payload):
+        if encoding == ENCODINGS["msgpack"]:
+            if msgpack is None:
+                raise RuntimeError("msgpack is required to read this cache entry.")
+            columnar = msgpack.unpackb(payload, raw=False, strict_map_key=False)
+        else:
+            columnar = pickle.loads(payload)
+        return from_columnar(columnar)
+
+    def _compress(self, payload):
+        if self.compression == "none" or len(payload) < self.compression_threshold:
+            return COMPRESSIONS["none"], payload
+        if self.compression == "zstd":
+            return COMPRESSIONS["zstd"], zstandard.ZstdCompressor().compress(payload)
+        return COMPRESSIONS["zlib"], zlib.compress(payload)
+
+    def _decompress(self, compression, payload):
+        if compression == COMPRESSIONS["zstd"]:
+            if zstandard is None:
+                raise RuntimeError("zstandard is required to read this cache entry.")
+            return zstandard.ZstdDecompressor().decompress(payload)
+        if compression == COMPRESSIONS["zlib"]:
+            return zlib.decompress(payload)
+        return payload
+
+    def dumps(self, value, protocol=pickle.HIGHEST_PROTOCOL):
+        if not isinstance(value, (dict, list)):
+            return super().dumps(value, protocol)
+        started = time.perf_counter()
+        encoding, payload = self._encode(value)
+        compression, stored = self._compress(payload)
+        flags = ENCODINGS[encoding] | (compression << 4)
+        dump = MAGIC + bytes([flags]) + stored
+        pickle_bytes = None
+        if self.stats.should_sample_baseline():
+            # Size of what the stock RedisSerializer would have stored.
+            pickle_bytes = len(pickle.dumps(value, protocol)) + 1
+        elapsed = time.perf_counter() - started
+        self.stats.record_encode(pickle_bytes, len(payload), len(dump), elapsed, compression != COMPRESSIONS["none"])
+        return dump
+
+    def loads(self, value):
+        if not isinstance(value, bytes) or not value.startswith(MAGIC):
+            return super().loads(value)
+        started = time.perf_counter()
+        try:
+            flags = value[1]
+            data = self._decode(flags & 0x0F, self._decompress(flags >> 4, value[2:]))
+        except Exception as e:
+            logger.warning(f"Failed to decode cache entry: {e}")
+            return None
+        self.stats.record_decode(time.perf_counter() - started)
+        return data
+
+    def dump(self, value, f, protocol=pickle.HIGHEST_PROTOCOL):
+        f.write(self.dumps(value, protocol))
+
+    def load(self, f):
+        data = f.read()
+        if data.startswith(MAGIC) or data.startswith(b"!"):
+            return self.loads(data)
+        # Entries written by the default FileSystemSerializer are plain pickles.
+        return BaseSerializer.loads(self, data)
+
+
+def approximate_size(value):
+    """Rough in-memory size of a cached value in bytes, used for the local tier's byte budget."""
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(approximate_size(key) + approximate_size(item) for key, item in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(approximate_size(item) for item in value)
+    return size
+
+
+class TieredCache(BaseCache):
+    """
+    Two-tier cache: a bounded in-process LRU in front of a shared cachelib cache.
+
+    Hot keys are served from process memory without a Redis round trip or a decode.
+    Writes and deletes go to the shared tier first and then update the local tier, so
+    a process always sees its own changes. Other processes may serve a value for up to
+    ``local_ttl`` seconds after it changed, which bounds how stale the local tier can get.
+    A local copy never outlives the shared entry's own expiry.
+
+    Values handed out by the local tier are shared between callers and must not be mutated.
+
+    :param shared: The shared cachelib cache (RedisCache or FileSystemCache).
+    :param max_bytes: Approximate memory budget of the local tier.
+    :param local_ttl: Seconds a value may live in the local tier.
+    """
+
+    def __init__(self, shared, max_bytes=64 * 1024 * 1024, local_ttl=60):
+        super().__init__(default_timeout=shared.default_timeout)
+        self.shared = shared
+        self.max_bytes = max_bytes
+        self.local_ttl = local_ttl
+        self._local = OrderedDict()
+        self._local_bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {"localHits": 0, "localMisses": 0, "sharedHits": 0, "sharedMisses": 0, "evictions": 0}
+
+    def _local_get(self, key):
+        """Returns (found, value) from the local tier, dropping the entry if it has expired."""
+        with self._lock:
+            entry = self._local.get(key)
+            if entry is None:
+                self._stats["localMisses"] += 1
+                return False, None
+            value, size, expires_at = entry
+            if expires_at <= time.monotonic():
+                self._discard(key)
+                self._stats["localMisses"] += 1
+                return False, None
+            self._local.move_to_end(key)
+            self._stats["localHits"] += 1
+            return True, value
+
+    def _local_set(self, key, value, timeout=None):
+        ttl = self.local_ttl
+        if timeout:
+            ttl = min(ttl, timeout)
+        size = approximate_size(value)
+        with self._lock:
+            self._discard(key)
+            if value is None or ttl <= 0 or size > self.max_bytes:
+                return
+            self._local[key] = (value, size, time.monotonic() + ttl)
+            self._local_bytes += size
+            while self._local_bytes > self.max_bytes:
+                oldest_key = next(iter(self._local))
+                self._discard(oldest_key)
+                self._stats["evictions"] += 1
+
+    def _discard(self, key):
+        # Callers hold self._lock.
+        entry = self._local.pop(key, None)
+        if entry is not None:
+            self._local_bytes -= entry[1]
+
+    def _record_shared(self, hit):
+        with self._lock:
+            self._stats["sharedHits" if hit else "sharedMisses"] += 1
+
+    def _remaining_lifetimes(self, keys):
+        """
+        Seconds each key has left in the shared tier: 0 if it never expires, negative if it is gone.
+
+        Read from Redis (PTTL) or from the expiry header FileSystemCache writes in front of each
+        entry. Other backends report None, and such values are kept locally for local_ttl.
+        """
+        if isinstance(self.shared, RedisCache):
+            pipe = self.shared._read_client.pipeline(transaction=False)
+            for key in keys:
+                pipe.pttl(self.shared.key_prefix + key)
+            # PTTL is -1 for keys without expiry and -2 for missing keys.
+            return [0 if pttl == -1 else (pttl / 1000 if pttl >= 0 else -1) for pttl in pipe.execute()]
+        if isinstance(self.shared, FileSystemCache):
+            lifetimes = []
+            now = time.time()
+            for key in keys:
+                try:
+                    with open(self.shared._get_filename(key), "rb") as f:
+                        expires = struct.unpack("I", f.read(4))[0]
+                except (OSError, struct.error):
+                    lifetimes.append(-1)
+                    continue
+                lifetimes.append(0 if expires == 0 else expires - now)
+            return lifetimes
+        return [None] * len(keys)
+
+    def _fill_from_shared(self, keys, values):
+        """Copies values read from the shared tier into the local tier, never outliving them there."""
+        found = [(key, value) for key, value in zip(keys, values) if value is not None]
+        if not found:
+            return
+        lifetimes = self._remaining_lifetimes([key for key, _ in found])
+        for (key, value), lifetime in zip(found, lifetimes):
+            if lifetime is None or lifetime == 0:
+                self._local_set(key, value)
+            elif lifetime > 0:
+                self._local_set(key, value, lifetime)
+
+    def get(self, key):
+        found, value = self._local_get(key)
+        if found:
+            return value
+        value = self.shared.get(key)
+        self._record_shared(value is not None)
+        self._fill_from_shared([key], [value])
+        return value
+
+    def get_many(self, *keys):
+        results = {}
+        missing = []
+        for key in keys:
+            found, value = self._local_get(key)
+            if found:
+                results[key] = value
+            else:
+                missing.append(key)
+        if missing:
+            values = self.shared.get_many(*missing)
+            for key, value in zip(missing, values):
+                self._record_shared(value is not None)
+                results[key] = value
+            self._fill_from_shared(missing, values)
+        return [results[key] for key in keys]
+
+    # Writes only reach the local tier once the shared tier accepted them; a failed
+    # write also drops any local copy, so the tiers never disagree.
+
+    def set(self, key, value, timeout=None):
+        result = self.shared.set(key, value, timeout)
+        if result:
+            self._local_set(key, value, self._normalize_timeout(timeout))
+        else:
+            with self._lock:
+                self._discard(key)
+        return result
+
+    def set_many(self, mapping, timeout=None):
+        set_keys = self.shared.set_many(mapping, timeout)
+        for key, value in mapping.items():
+            if key in set_keys:
+                self._local_set(key, value, self._normalize_timeout(timeout))
+            else:
+                with self._lock:
+                    self._discard(key)
+        return set_keys
+
+    def add(self, key, value, timeout=None):
+        added = self.shared.add(key, value, timeout)
+        if added:
+            self._local_set(key, value, self._normalize_timeout(timeout))
+        return added
+
+    def delete(self, key):
+        with self._lock:
+            self._discard(key)
+        return self.shared.delete(key)
+
+    def delete_many(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._discard(key)
+        return self.shared.delete_many(*keys)
+
+    def has(self, key):
+        # Existence checks are not lookups, so they stay out of the hit/miss counters.
+        with self._lock:
+            entry = self._local.get(key)
+            if entry is not None and entry[2] > time.monotonic():
+                return True
+        return self.shared.has(key)
+
+    def clear(self):
+        with self._lock:
+            self._local.clear()
+            self._local_bytes = 0
+        return self.shared.clear()
+
+    def inc(self, key, delta=1):
+        with self._lock:
+            self._discard(key)
+        return self.shared.inc(key, delta)
+
+    def dec(self, key, delta=1):
+        with self._lock:
+            self._discard(key)
+        return self.shared.dec(key, delta)
+
+    def stats(self):
+        """Per-tier hit/miss counters plus the local tier's current footprint."""
+        with self._lock:
+            return {**self._stats, "localEntries": len(self._local), "localBytes": self._local_bytes}
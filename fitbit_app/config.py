@@ -16,6 +16,11 @@ FRONTEND_URL = os.getenv("FRONTEND_URL", "http://127.0.0.1:3000")
 
 # Cache Configuration
 REDIS_URL = os.getenv("REDIS_URL")
+CACHE_ENCODING = os.getenv("CACHE_ENCODING", "msgpack")
+CACHE_COMPRESSION = os.getenv("CACHE_COMPRESSION", "zlib")
+CACHE_COMPRESSION_THRESHOLD = int(os.getenv("CACHE_COMPRESSION_THRESHOLD", "1024"))
+LOCAL_CACHE_MAX_BYTES = int(os.getenv("LOCAL_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+LOCAL_CACHE_TTL = int(os.getenv("LOCAL_CACHE_TTL", "60"))
 
 # Fitbit OAuth 2.0 configuration
 CLIENT_ID = os.getenv("FITBIT_CLIENT_ID")
@@ -0,0 +1,252 @@
+"""
+Batch export of heart rate, sleep and SpO2 data for many users.
+
+Reads a CSV of jobs (``user_id,start_date,end_date``) and writes one Parquet file per
+dataset, user and day under the output directory, e.g.::
+
+    export/heart_rate/user_id=ABC123/date=2024-01-01/part.parquet
+
+Each user's jobs run sequentially in one worker process so that token refreshes and
+Fitbit's per-user rate limit are handled in one place; different users run in parallel.
+Finished days are recorded in a per-user checkpoint file, so an interrupted export
+picks up where it left off when run again. A failed Fitbit request stops that user's
+export before the day is checkpointed, so the day is retried on the next run.
+
+Usage::
+
+    python -m fitbit_app.export --jobs jobs.csv --tokens tokens/ --out export/
+"""
+import argparse
+import csv
+import json
+import logging
+import os
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
+
+import pandas as pd
+from flask import Flask
+from requests import HTTPError
+from requests_oauthlib import OAuth2Session
+
+from fitbit_app import config
+from fitbit_app.api_client import (
+    fetch_daily_heart_rate,
+    fetch_intraday_heart_rate,
+    fetch_sleep_logs,
+    fetch_spo2_intraday,
+)
+from fitbit_app.processor import (
+    process_sleep_data_for_api,
+    process_resting_heart_rate_for_api,
+    process_spo2_data_for_api,
+    summarize_sleep_logs,
+    intraday_heart_rate_to_df,
+)
+
+# Fitbit allows 150 API requests per user per hour.
+DEFAULT_REQUESTS_PER_HOUR = 150
+MAX_RATE_LIMIT_RETRIES = 3
+# Fitbit's heart rate time series accepts at most one year per request.
+MAX_TIME_SERIES_DAYS = 365
+
+logger = logging.getLogger(__name__)
+
+
+class RateLimitedSession(OAuth2Session):
+    """
+    OAuth2Session that spaces out requests and waits out HTTP 429 responses.
+
+    Any other non-200 response, or a 429 that outlasts the retries, raises HTTPError. The
+    fetch_* helpers would otherwise log it and return empty data, which the export cannot
+    tell apart from a day without data, and the day would be checkpointed as done.
+    """
+
+    def __init__(self, *args, requests_per_hour=DEFAULT_REQUESTS_PER_HOUR, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.min_interval = 3600 / requests_per_hour
+        self.last_request_at = 0.0
+
+    def request(self, method, url, *args, **kwargs):
+        for _ in range(MAX_RATE_LIMIT_RETRIES + 1):
+            wait = self.last_request_at + self.min_interval - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            self.last_request_at = time.monotonic()
+            response = super().request(method, url, *args, **kwargs)
+            if response.status_code == 200:
+                return response
+            if response.status_code != 429:
+                break
+            # Fitbit reports the seconds left until the hourly quota resets.
+            reset_seconds = int(response.headers.get("Fitbit-Rate-Limit-Reset", 60))
+            logger.warning(f"Rate limited on {url}, waiting {reset_seconds + 1}s.")
+            time.sleep(reset_seconds + 1)
+        raise HTTPError(f"Fitbit request to {url} failed with status code {response.status_code}: {response.text}", response=response)
+
+
+def load_jobs(jobs_path):
+    """Reads (user_id, start_date, end_date) jobs from a CSV file, grouped by user."""
+    jobs = defaultdict(list)
+    with open(jobs_path, newline="") as f:
+        for row in csv.DictReader(f):
+            start_date = datetime.strptime(row["start_date"], "%Y-%m-%d").date()
+            end_date = datetime.strptime(row["end_date"], "%Y-%m-%d").date()
+            jobs[row["user_id"]].append((start_date, end_date))
+    return jobs
+
+
+def get_export_session(user_id, tokens_dir, requests_per_hour):
+    """Builds a rate-limited Fitbit session from the user's stored token, saving refreshed tokens back."""
+    token_path = os.path.join(tokens_dir, f"{user_id}.json")
+    with open(token_path) as f:
+        token = json.load(f)
+
+    def save_token(new_token):
+        # Refresh tokens are single-use, so never leave a half-written token file behind.
+        tmp_path = f"{token_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(new_token, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, token_path)
+
+    return RateLimitedSession(
+        config.CLIENT_ID,
+        token=token,
+        auto_refresh_url=config.TOKEN_URL,
+        auto_refresh_kwargs={
+            "client_id": config.CLIENT_ID,
+            "client_secret": config.CLIENT_SECRET,
+        },
+        token_updater=save_token,
+        requests_per_hour=requests_per_hour,
+    )
+
+
+def read_checkpoint(checkpoint_path):
+    if not os.path.exists(checkpoint_path):
+        return set()
+    with open(checkpoint_path) as f:
+        return {line.strip() for line in f if line.strip()}
+
+
+def write_partition(out_dir, dataset, user_id, date_str, rows):
+    """Writes one dataset/user/day partition, replacing whatever an interrupted run left behind."""
+    if not rows:
+        return
+    partition_dir = os.path.join(out_dir, dataset, f"user_id={user_id}", f"date={date_str}")
+    os.makedirs(partition_dir, exist_ok=True)
+    pd.DataFrame(rows).to_parquet(os.path.join(partition_dir, "part.parquet"), index=False)
+
+
+def fetch_day_heart_rate(fitbit, day):
+    return fetch_intraday_heart_rate(fitbit, datetime.combine(day, datetime.min.time()), datetime.combine(day, datetime.max.time()))
+
+
+def export_day(fitbit, out_dir, user_id, day, heart_rate_data, previous_heart_rate_data, resting_heart_rate):
+    """Fetches sleep and SpO2 for one day and writes all of that day's partitions."""
+    date_str = day.strftime("%Y-%m-%d")
+    day_start = datetime.combine(day, datetime.min.time())
+
+    hr_df = intraday_heart_rate_to_df(heart_rate_data)
+    write_partition(out_dir, "heart_rate", user_id, date_str, hr_df[["time", "value"]].to_dict("records") if not hr_df.empty else [])
+
+    # Fitbit files a night under the day it ends on, so the window starts the evening before.
+    all_sleep_logs = fetch_sleep_logs(fitbit, day_start, day_start)
+    window_start = (day_start - timedelta(days=1)).replace(tzinfo=timezone.utc)
+    window_end = (day_start + timedelta(days=1)).replace(tzinfo=timezone.utc)
+    sleep_data = process_sleep_data_for_api(all_sleep_logs, None, None, window_start, window_end)
+    write_partition(out_dir, "sleep_stages", user_id, date_str, sleep_data["sleepStages"])
+
+    # Each day was fetched separately, so date its samples from its own response instead of
+    # joining the two days and guessing the date boundary from the sample times.
+    sleep_hr_df = pd.concat([intraday_heart_rate_to_df(previous_heart_rate_data), hr_df], ignore_index=True)
+    summaries = summarize_sleep_logs(all_sleep_logs, None, window_start, window_end, hr_df=sleep_hr_df)
+    summary_rows = []
+    for summary in summaries:
+        row = {key: value for key, value in summary.items() if key != "minutesByStage"}
+        row.update({f"{stage}Minutes": minutes for stage, minutes in summary["minutesByStage"].items()})
+        summary_rows.append(row)
+    write_partition(out_dir, "sleep_summary", user_id, date_str, summary_rows)
+
+    spo2_data = process_spo2_data_for_api(fetch_spo2_intraday(fitbit, day_start, day_start))
+    write_partition(out_dir, "spo2", user_id, date_str, spo2_data.get("minutes", []))
+
+    write_partition(out_dir, "resting_heart_rate", user_id, date_str, [resting_heart_rate] if resting_heart_rate else [])
+
+
+def export_user(user_id, date_ranges, tokens_dir, out_dir, requests_per_hour):
+    """Runs all jobs of one user; executed in a worker process."""
+    logging.basicConfig(level=logging.INFO)
+    # The fetch_* helpers log through current_app, so give them an app context.
+    app = Flask(__name__)
+    with app.app_context():
+        fitbit = get_export_session(user_id, tokens_dir, requests_per_hour)
+        checkpoint_path = os.path.join(out_dir, "_checkpoints", f"{user_id}.txt")
+        os.makedirs(os.path.dirname(checkpoint_path), exist_ok=True)
+        done = read_checkpoint(checkpoint_path)
+        exported = 0
+
+        for start_date, end_date in date_ranges:
+            days = [start_date + timedelta(days=x) for x in range((end_date - start_date).days + 1)]
+            pending = [day for day in days if day.strftime("%Y-%m-%d") not in done]
+            if not pending:
+                continue
+
+            resting_heart_rates = {}
+            chunk_start = pending[0]
+            while chunk_start <= pending[-1]:
+                chunk_end = min(pending[-1], chunk_start + timedelta(days=MAX_TIME_SERIES_DAYS - 1))
+                daily_heart_rate_data = fetch_daily_heart_rate(fitbit, chunk_start, chunk_end)
+                resting_heart_rates.update({item["date"]: item for item in process_resting_heart_rate_for_api(daily_heart_rate_data)})
+                chunk_start = chunk_end + timedelta(days=1)
+
+            previous_day = None
+            previous_heart_rate_data = None
+            for day in pending:
+                date_str = day.strftime("%Y-%m-%d")
+                # The night filed under this day starts the evening before, so its heart rate is needed too.
+                if previous_day != day - timedelta(days=1):
+                    previous_heart_rate_data = fetch_day_heart_rate(fitbit, day - timedelta(days=1))
+                heart_rate_data = fetch_day_heart_rate(fitbit, day)
+                export_day(fitbit, out_dir, user_id, day, heart_rate_data, previous_heart_rate_data, resting_heart_rates.get(date_str))
+                with open(checkpoint_path, "a") as f:
+                    f.write(date_str + "\n")
+                done.add(date_str)
+                exported += 1
+                previous_day = day
+                previous_heart_rate_data = heart_rate_data
+
+    return user_id, exported
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export Fitbit data for many users to partitioned Parquet files.")
+    parser.add_argument("--jobs", required=True, help="CSV file with user_id,start_date,end_date rows.")
+    parser.add_argument("--tokens", required=True, help="Directory holding one <user_id>.json OAuth token per user.")
+    parser.add_argument("--out", required=True, help="Output directory.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="Number of users exported in parallel.")
+    parser.add_argument("--requests-per-hour", type=int, default=DEFAULT_REQUESTS_PER_HOUR, help="Per-user Fitbit request budget.")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    jobs = load_jobs(args.jobs)
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = {
+            executor.submit(export_user, user_id, date_ranges, args.tokens, args.out, args.requests_per_hour): user_id
+            for user_id, date_ranges in jobs.items()
+        }
+        for future in as_completed(futures):
+            user_id = futures[future]
+            try:
+                _, exported = future.result()
+                logger.info(f"Exported {exported} day(s) for user {user_id}.")
+            except Exception as e:
+                logger.error(f"Export for user {user_id} failed, rerun to resume: {e}")
+
+
+if __name__ == "__main__":
+    main()
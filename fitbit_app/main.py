@@ -1,6 +1,6 @@
 import os
 import logging
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from functools import wraps
 from flask import Flask, redirect, request, session, url_for, render_template
 from flask_cors import CORS
@@ -15,10 +15,13 @@ import redis
 from cachelib import FileSystemCache, RedisCache
 
 from fitbit_app import config
+from fitbit_app.cache import CodecSerializer, TieredCache
 from fitbit_app.api_client import (
     get_fitbit_session,
+    get_fitbit_user_id,
     fetch_daily_heart_rate,
     fetch_intraday_heart_rate,
+    fetch_intraday_heart_rate_incremental,
     fetch_sleep_logs,
     fetch_spo2_intraday,
 )
@@ -26,7 +29,10 @@ from fitbit_app.processor import (
     process_sleep_data,
     process_sleep_data_for_api,
     process_resting_heart_rate_for_api,
+    process_resting_heart_rate_range,
+    find_missing_date_runs,
     process_spo2_data_for_api,
+    summarize_sleep_logs,
 )
 from fitbit_app.utils import login_required
 
@@ -46,11 +52,31 @@ app.config.update(
 # Cache setup
 if config.REDIS_URL:
     redis_client = redis.from_url(config.REDIS_URL)
-    cache = RedisCache(redis_client, default_timeout=0)
+    shared_cache = RedisCache(redis_client, default_timeout=0)
     app.logger.info("Using Redis cache for production.")
 else:
-    cache = FileSystemCache('.cache', threshold=500, default_timeout=0)
+    shared_cache = FileSystemCache('.cache', threshold=500, default_timeout=0)
     app.logger.info("Using FileSystemCache for local development.")
+shared_cache.serializer = CodecSerializer(
+    encoding=config.CACHE_ENCODING,
+    compression=config.CACHE_COMPRESSION,
+    compression_threshold=config.CACHE_COMPRESSION_THRESHOLD,
+)
+# Hot keys are served from process memory before going to Redis or disk.
+cache = TieredCache(
+    shared_cache,
+    max_bytes=config.LOCAL_CACHE_MAX_BYTES,
+    local_ttl=config.LOCAL_CACHE_TTL,
+)
+
+def store_sleep_summaries(all_sleep_logs, heart_rate_data, start_datetime, end_datetime):
+    """Computes per-night sleep summaries for freshly fetched data and caches them for the current user."""
+    summaries = summarize_sleep_logs(all_sleep_logs, heart_rate_data, start_datetime, end_datetime)
+    if not summaries:
+        return
+    # Always overwrite, so a night first ingested before its heart rate synced picks up the HR stats later.
+    user_id = get_fitbit_user_id()
+    cache.set_many({f"sleep_summary_{user_id}_{summary['date']}": summary for summary in summaries})
 
 # elaborate CORS configuration
 CORS(app,
@@ -213,26 +239,15 @@ def detailed_heart_rate():
         if start_datetime_str and end_datetime_str:
             start_time = datetime.strptime(start_datetime_str, '%Y-%m-%dT%H:%M')
             end_time = datetime.strptime(end_datetime_str, '%Y-%m-%dT%H:%M')
+            intraday_data = fetch_intraday_heart_rate(fitbit, start_time, end_time)
         else:
+            # The default rolling window is refreshed often, so only fetch what is new since the last refresh.
             end_time = datetime.now()
             start_time = end_time - timedelta(hours=23)
+            intraday_data = fetch_intraday_heart_rate_incremental(fitbit, cache, get_fitbit_user_id(), start_time, end_time)
 
-        start_date_str = start_time.strftime('%Y-%m-%d')
-        end_date_str = end_time.strftime('%Y-%m-%d')
-        start_time_str = start_time.strftime('%H:%M')
-        end_time_str = end_time.strftime('%H:%M')
-
-        api_url = (
-            f"https://api.fitbit.com/1/user/-/activities/heart/date/{start_date_str}/{end_date_str}/1min/"
-            f"time/{start_time_str}/{end_time_str}.json"
-        )
-        response = fitbit.get(api_url)
-
-        if response.status_code == 200:
-            intraday_data = response.json()
-        else:
-            intraday_data = None
-            app.logger.error(f"Fitbit API request failed with status code {response.status_code}: {response.text}")
+        if intraday_data is None:
+            app.logger.error(f"Fitbit API request for intraday heart rate between {start_time} and {end_time} failed.")
 
         return render_template(
             "detailed_heart_rate.html",
@@ -255,14 +270,24 @@ def detailed_sleep_data():
         if start_datetime_str and end_datetime_str:
             start_datetime = datetime.strptime(start_datetime_str, '%Y-%m-%dT%H:%M')
             end_datetime = datetime.strptime(end_datetime_str, '%Y-%m-%dT%H:%M')
+            incremental = False
         else:
             end_datetime = datetime.now()
             start_datetime = end_datetime - timedelta(hours=23)
+            incremental = True
 
-        heart_rate_data = fetch_intraday_heart_rate(fitbit, start_datetime, end_datetime)
+        if incremental:
+            heart_rate_data = fetch_intraday_heart_rate_incremental(fitbit, cache, get_fitbit_user_id(), start_datetime, end_datetime)
+        else:
+            heart_rate_data = fetch_intraday_heart_rate(fitbit, start_datetime, end_datetime)
         all_sleep_logs = fetch_sleep_logs(fitbit, start_datetime, end_datetime)
 
         graphJSON, total_awake_time = process_sleep_data(all_sleep_logs, heart_rate_data, start_datetime, end_datetime)
+        # This view's naive local times are treated as UTC, like the API route does.
+        store_sleep_summaries(
+            all_sleep_logs, heart_rate_data,
+            start_datetime.replace(tzinfo=timezone.utc), end_datetime.replace(tzinfo=timezone.utc)
+        )
 
         return render_template(
             "detailed_sleep_data.html",
@@ -275,6 +300,9 @@ def detailed_sleep_data():
         session.pop("oauth_token", None)
         return redirect(url_for("login"))
 
+# Dates with no resting heart rate to report are cached as empty markers for this long
+RHR_MISSING_MARKER_TIMEOUT = 60 * 60
+
 @app.route("/api/v1/resting-heart-rate")
 @login_required
 def api_resting_heart_rate():
@@ -291,56 +319,48 @@ def api_resting_heart_rate():
         
         all_requested_date_strs = [ (start_date + timedelta(days=x)).strftime('%Y-%m-%d') for x in range((end_date - start_date).days + 1) ]
         cache_keys = [f"rhr_{date_str}" for date_str in all_requested_date_strs]
+        # The day before the range seeds the backfill of a gap at the start of the range
+        seed_date = start_date - timedelta(days=1)
+        seed_date_str = seed_date.strftime('%Y-%m-%d')
         
         # Bulk get from cache
-        cached_results = cache.get_many(*cache_keys)
+        seed_result, *cached_results = cache.get_many(f"rhr_{seed_date_str}", *cache_keys)
         cached_data = {result['date']: result for result in cached_results if result and isinstance(result, dict) and 'date' in result}
 
-        # Identify missing dates
-        missing_date_strs = [date_str for date_str in all_requested_date_strs if date_str not in cached_data]
-        
-        if missing_date_strs:
-            missing_dates = [datetime.strptime(date_str, '%Y-%m-%d').date() for date_str in missing_date_strs]
-            min_missing_date = min(missing_dates)
-            max_missing_date = max(missing_dates)
-            
-            newly_fetched_data = fetch_daily_heart_rate(fitbit, min_missing_date, max_missing_date)
-            
-            to_cache = {}
-            if newly_fetched_data and 'activities-heart' in newly_fetched_data:
-                processed_new_data = process_resting_heart_rate_for_api(newly_fetched_data)
-                processed_data_map = {item['date']: item for item in processed_new_data}
-
-                # Backfill logic
-                # Sort all available data by date to find the last known RHR
-                all_available_data = sorted(list(cached_data.values()) + processed_new_data, key=lambda x: x['date'])
-                last_known_rhr = None
-                if all_available_data:
-                    # Find the last entry that has a valid restingHeartRate
-                    for item in reversed(all_available_data):
-                        if item.get('restingHeartRate') is not None:
-                            last_known_rhr = item['restingHeartRate']
-                            break
-                
-                for date_str in missing_date_strs:
-                    if date_str in processed_data_map:
-                        # This date had a valid RHR from the API
-                        day_data = processed_data_map[date_str]
-                        to_cache[f"rhr_{day_data['date']}"] = day_data
-                        cached_data[day_data['date']] = day_data
-                    else:
-                        # This date is missing from the API response, backfill it
-                        if last_known_rhr is not None:
-                            backfilled_data = {'date': date_str, 'restingHeartRate': last_known_rhr}
-                            to_cache[f"rhr_{date_str}"] = backfilled_data
-                            cached_data[date_str] = backfilled_data
-            
+        # Fetch each contiguous run of missing dates with one range call
+        newly_fetched_data = []
+        fetched_date_strs = set()
+        for run_start, run_end in find_missing_date_runs(start_date, end_date, cached_data.keys()):
+            fetch_start = seed_date if run_start == start_date and not seed_result else run_start
+            daily_heart_rate_data = fetch_daily_heart_rate(fitbit, fetch_start, run_end)
+            if daily_heart_rate_data and 'activities-heart' in daily_heart_rate_data:
+                newly_fetched_data.extend(process_resting_heart_rate_for_api(daily_heart_rate_data))
+                fetched_date_strs.update(
+                    (run_start + timedelta(days=x)).strftime('%Y-%m-%d') for x in range((run_end - run_start).days + 1)
+                )
+
+        final_data = list(cached_data.values())
+        if fetched_date_strs:
+            # Backfill each gap from the last known RHR before it. Dates in runs whose fetch
+            # failed are left out and uncached, so the next request retries them.
+            known_data = final_data + newly_fetched_data + ([seed_result] if seed_result else [])
+            filled_data = {item['date']: item for item in process_resting_heart_rate_range(start_date, end_date, known_data)}
+            to_cache = {f"rhr_{item['date']}": item for item in newly_fetched_data if item['date'] == seed_date_str}
+            missing_markers = {}
+            for date_str in sorted(fetched_date_strs):
+                item = filled_data.get(date_str)
+                if item:
+                    to_cache[f"rhr_{date_str}"] = item
+                    final_data.append(item)
+                else:
+                    # Nothing to backfill from yet; remember that for a while so it is not refetched on every request
+                    missing_markers[f"rhr_{date_str}"] = {'date': date_str, 'restingHeartRate': None}
             if to_cache:
                 cache.set_many(to_cache)
+            if missing_markers:
+                cache.set_many(missing_markers, timeout=RHR_MISSING_MARKER_TIMEOUT)
 
-        # Reconstruct the final list in the correct order
-        final_data = [cached_data[date_str] for date_str in all_requested_date_strs if date_str in cached_data]
-        final_data = sorted(final_data, key=lambda x: x['date'])
+        final_data = sorted((item for item in final_data if item.get('restingHeartRate') is not None), key=lambda x: x['date'])
         
         return jsonify(final_data)
 
@@ -360,7 +380,8 @@ def api_sleep_data():
         start_datetime_str = request.args.get('start_datetime')
         end_datetime_str = request.args.get('end_datetime')
 
-        cache_key = f"sleep_data_{start_datetime_str}_{end_datetime_str}"
+        # Scoped per user: a shared response would also skip ingesting this user's sleep summaries.
+        cache_key = f"sleep_data_{get_fitbit_user_id()}_{start_datetime_str}_{end_datetime_str}"
         
         cached_response = cache.get(cache_key)
         if cached_response:
@@ -378,6 +399,7 @@ def api_sleep_data():
         all_sleep_logs = fetch_sleep_logs(fitbit, start_datetime, end_datetime)
 
         processed_data = process_sleep_data_for_api(all_sleep_logs, heart_rate_data, daily_heart_rate_data, start_datetime, end_datetime)
+        store_sleep_summaries(all_sleep_logs, heart_rate_data, start_datetime, end_datetime)
 
         cache.set(cache_key, processed_data)
         return jsonify(processed_data)
@@ -387,6 +409,33 @@ def api_sleep_data():
     except Exception as e:
         app.logger.error(f"An error occurred in /api/v1/sleep-data: {e}")
 
+@app.route("/api/v1/sleep-trends")
+@login_required
+def api_sleep_trends():
+    """Serves stored per-night sleep summaries without calling the Fitbit API."""
+    try:
+        start_date_str = request.args.get('start_date')
+        end_date_str = request.args.get('end_date')
+
+        if not start_date_str or not end_date_str:
+            return jsonify({"error": "start_date and end_date parameters are required"}), 400
+
+        start_date = datetime.strptime(start_date_str, '%Y-%m-%d').date()
+        end_date = datetime.strptime(end_date_str, '%Y-%m-%d').date()
+
+        user_id = get_fitbit_user_id()
+        cache_keys = [f"sleep_summary_{user_id}_{(start_date + timedelta(days=x)).strftime('%Y-%m-%d')}" for x in range((end_date - start_date).days + 1)]
+        cached_results = cache.get_many(*cache_keys) if cache_keys else []
+
+        summaries = [result for result in cached_results if result and isinstance(result, dict) and 'date' in result]
+        return jsonify(summaries)
+
+    except ValueError:
+        return jsonify({"error": "Invalid date format. Please use YYYY-MM-DD."}), 400
+    except Exception as e:
+        app.logger.error(f"An error occurred in /api/v1/sleep-trends: {e}")
+        return jsonify({"error": "internal_server_error"}), 500
+
 @app.route("/api/v1/spo2-intraday")
 @login_required
 def api_spo2_intraday():
@@ -428,6 +477,15 @@ def auth_status():
     """A lightweight endpoint to check if the user has an active session."""
     return jsonify({"isAuthenticated": True})
 
+@app.route("/api/v1/cache-stats")
+@login_required
+def api_cache_stats():
+    """Reports per-tier cache hits and misses, bytes saved by the cache codec and its encode/decode cost."""
+    codec_stats = shared_cache.serializer.stats.snapshot()
+    codec_stats["encoding"] = shared_cache.serializer.encoding
+    codec_stats["compression"] = shared_cache.serializer.compression
+    return jsonify({"tiers": cache.stats(), "codec": codec_stats})
+
 # CORS handling for all responses
 @app.after_request
 def after_request(response):
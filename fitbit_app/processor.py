@@ -86,6 +86,30 @@ def process_sleep_data(all_sleep_logs, heart_rate_data, start_datetime, end_date
             total_awake_time = all_sleep_df[all_sleep_df['level'] == 'wake']['seconds'].sum()
     return graphJSON, total_awake_time
 
+def intraday_heart_rate_to_df(heart_rate_data):
+    """Converts an intraday heart rate response into a DataFrame with timezone-aware (UTC) timestamps."""
+    if not heart_rate_data or 'activities-heart-intraday' not in heart_rate_data:
+        return pd.DataFrame()
+    intraday_dataset = heart_rate_data['activities-heart-intraday']['dataset']
+    if not intraday_dataset:
+        return pd.DataFrame()
+
+    hr_df = pd.DataFrame(intraday_dataset)
+    start_date_str = heart_rate_data['activities-heart'][0]['dateTime']
+    current_date = datetime.strptime(start_date_str, '%Y-%m-%d').date()
+
+    timestamps = []
+    last_time = None
+    for t_str in hr_df['time']:
+        time_obj = datetime.strptime(t_str, '%H:%M:%S').time()
+        if last_time and time_obj < last_time:
+            current_date += timedelta(days=1)
+        timestamps.append(datetime.combine(current_date, time_obj).replace(tzinfo=timezone.utc))
+        last_time = time_obj
+
+    hr_df['time'] = timestamps
+    return hr_df
+
 def process_sleep_data_for_api(all_sleep_logs, heart_rate_data, daily_heart_rate_data, start_datetime, end_datetime):
     """Processes sleep and heart rate data and returns it in a structured JSON format for an API."""
     processed_data = {
@@ -128,32 +152,15 @@ def process_sleep_data_for_api(all_sleep_logs, heart_rate_data, daily_heart_rate
 
 
     # Process heart rate
-    if heart_rate_data and 'activities-heart-intraday' in heart_rate_data:
-        intraday_dataset = heart_rate_data['activities-heart-intraday']['dataset']
-        if intraday_dataset:
-            hr_df = pd.DataFrame(intraday_dataset)
-            start_date_str = heart_rate_data['activities-heart'][0]['dateTime']
-            current_date = datetime.strptime(start_date_str, '%Y-%m-%d').date()
-            
-            timestamps = []
-            last_time = None
-            for t_str in hr_df['time']:
-                time_obj = datetime.strptime(t_str, '%H:%M:%S').time()
-                if last_time and time_obj < last_time:
-                    current_date += timedelta(days=1)
-                # Make the timestamp timezone-aware (UTC)
-                aware_timestamp = datetime.combine(current_date, time_obj).replace(tzinfo=timezone.utc)
-                timestamps.append(aware_timestamp)
-                last_time = time_obj
-            
-            hr_df['time'] = timestamps
-            hr_df = hr_df[(hr_df['time'] >= start_datetime) & (hr_df['time'] <= end_datetime)]
+    hr_df = intraday_heart_rate_to_df(heart_rate_data)
+    if not hr_df.empty:
+        hr_df = hr_df[(hr_df['time'] >= start_datetime) & (hr_df['time'] <= end_datetime)]
 
-            for index, row in hr_df.iterrows():
-                processed_data["heartRate"].append({
-                    "time": row["time"].isoformat(),
-                    "value": row["value"]
-                })
+        for index, row in hr_df.iterrows():
+            processed_data["heartRate"].append({
+                "time": row["time"].isoformat(),
+                "value": row["value"]
+            })
 
     # Process resting heart rate for the start date
     if daily_heart_rate_data and 'activities-heart' in daily_heart_rate_data and daily_heart_rate_data['activities-heart']:
@@ -175,6 +182,104 @@ def process_resting_heart_rate_for_api(daily_heart_rate_data):
                 resting_heart_rate_list.append({'date': date, 'restingHeartRate': resting_heart_rate})
     return resting_heart_rate_list
 
+def find_missing_date_runs(start_date, end_date, available_date_strs):
+    """
+    Groups the dates in [start_date, end_date] that are not in available_date_strs into contiguous runs.
+
+    :return: A list of (run_start, run_end) date tuples, each of which can be fetched with one range call.
+    """
+    dates = pd.date_range(start_date, end_date, freq='D')
+    missing = ~dates.strftime('%Y-%m-%d').isin(list(available_date_strs))
+    if not missing.any():
+        return []
+    missing = pd.Series(missing, index=dates)
+    # A new run starts wherever the missing flag flips, so the cumulative flip count labels each run.
+    run_ids = (missing != missing.shift()).cumsum()[missing]
+    runs = run_ids.index.to_series().groupby(run_ids.values).agg(['min', 'max'])
+    return [(row['min'].date(), row['max'].date()) for _, row in runs.iterrows()]
+
+def process_resting_heart_rate_range(start_date, end_date, resting_heart_rate_list):
+    """
+    Lays resting heart rate records out over every date in [start_date, end_date] and backfills gaps.
+
+    Each missing date takes the most recent resting heart rate before it, so every gap is filled from
+    the value just before that gap. Records dated before start_date seed the fill for a leading gap;
+    dates before the first known value stay missing.
+
+    :param resting_heart_rate_list: Known {'date', 'restingHeartRate'} records, in any order. Records
+        with a None restingHeartRate are ignored.
+    :return: A date-ordered list of {'date', 'restingHeartRate'} records.
+    """
+    dates = pd.date_range(start_date, end_date, freq='D')
+    if not resting_heart_rate_list:
+        return []
+    known = pd.DataFrame(resting_heart_rate_list, columns=['date', 'restingHeartRate'])
+    known = known.dropna(subset=['restingHeartRate'])
+    known['date'] = pd.to_datetime(known['date'])
+    rhr = known.drop_duplicates('date', keep='last').set_index('date')['restingHeartRate'].sort_index()
+    rhr = rhr.reindex(dates.union(rhr.index)).ffill().reindex(dates).dropna()
+    return [
+        {'date': date.strftime('%Y-%m-%d'), 'restingHeartRate': int(value)}
+        for date, value in rhr.items()
+    ]
+
+def summarize_sleep_logs(all_sleep_logs, heart_rate_data, start_datetime, end_datetime, hr_df=None):
+    """
+    Builds one summary record per night from the main sleep logs that lie fully inside the fetched window.
+
+    Nights only partly covered by the window are skipped, since their heart rate statistics would be incomplete.
+
+    :param all_sleep_logs: The raw sleep logs from the Fitbit API.
+    :param heart_rate_data: The raw intraday heart rate data covering the window.
+    :param hr_df: Optional heart rate DataFrame (as built by intraday_heart_rate_to_df) used instead of
+        heart_rate_data, for samples that were fetched and dated one day at a time.
+    :return: A list of summary dicts keyed by ``date`` (the Fitbit ``dateOfSleep``).
+    """
+    summaries = []
+    if not all_sleep_logs:
+        return summaries
+
+    if hr_df is None:
+        hr_df = intraday_heart_rate_to_df(heart_rate_data)
+
+    for sleep_log in all_sleep_logs:
+        if not sleep_log.get('isMainSleep', True):
+            continue
+        log_start_time = datetime.fromisoformat(sleep_log['startTime']).replace(tzinfo=timezone.utc)
+        log_end_time = datetime.fromisoformat(sleep_log['endTime']).replace(tzinfo=timezone.utc)
+        if log_start_time < start_datetime or log_end_time > end_datetime:
+            continue
+
+        minutes_by_stage = {'deep': 0, 'light': 0, 'rem': 0, 'wake': 0}
+        stage_data = sleep_log.get('levels', {}).get('data', [])
+        if stage_data:
+            stage_df = pd.DataFrame(stage_data)
+            for level, seconds in stage_df.groupby('level')['seconds'].sum().items():
+                minutes_by_stage[level] = round(seconds / 60)
+
+        efficiency = sleep_log.get('efficiency')
+        if efficiency is None and sleep_log.get('timeInBed'):
+            efficiency = round(100 * sleep_log.get('minutesAsleep', 0) / sleep_log['timeInBed'])
+
+        min_heart_rate = None
+        mean_heart_rate = None
+        if not hr_df.empty:
+            sleep_hr = hr_df[(hr_df['time'] >= log_start_time) & (hr_df['time'] <= log_end_time)]['value']
+            if not sleep_hr.empty:
+                min_heart_rate = int(sleep_hr.min())
+                mean_heart_rate = round(float(sleep_hr.mean()), 1)
+
+        summaries.append({
+            "date": sleep_log.get('dateOfSleep', log_end_time.strftime('%Y-%m-%d')),
+            "onsetTime": log_start_time.isoformat(),
+            "wakeTime": log_end_time.isoformat(),
+            "minutesByStage": minutes_by_stage,
+            "efficiency": efficiency,
+            "minHeartRate": min_heart_rate,
+            "meanHeartRate": mean_heart_rate
+        })
+    return summaries
+
 def process_spo2_data_for_api(spo2_data):
     """
     Processes intraday SpO2 data for the API.